@@ -24,16 +24,27 @@ Notes:
   - Respect community norms; interactions are opt-in only.
 """
 
+import io
 import os
+import re
 import sys
 import json
+import mmap
 import time
 import random
+import signal
 import argparse
+import atexit
+import email.utils
 import datetime as dt
+import functools
+import itertools
+import hashlib
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional
+from collections import deque
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator, Deque, Set, Callable
 
 try:
     from zoneinfo import ZoneInfo  # Python 3.9+
@@ -41,7 +52,27 @@ except ImportError:  # pragma: no cover
     from backports.zoneinfo import ZoneInfo  # type: ignore
 
 # Bluesky SDK
-from atproto import Client, models as M
+import httpx
+from atproto import Client, Request, models as M
+
+try:
+    import h2  # noqa: F401  # HTTP/2 pour httpx (optionnel)
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    HTTP2_AVAILABLE = False
+
+try:
+    from PIL import Image  # réduction des images trop lourdes (optionnel)
+    PIL_AVAILABLE = True
+except ImportError:  # pragma: no cover
+    PIL_AVAILABLE = False
+
+try:
+    import orjson  # (dé)sérialisation du state plus rapide (optionnel)
+except ImportError:  # pragma: no cover
+    orjson = None
+
+_rng = random.Random()  # générateur propre au bot (tirages, délais, jitter)
 
 # ========== USER CONFIG ==========
 SITE_URL = "https://louphi1987.github.io/Site_de_Louphi/"
@@ -51,12 +82,30 @@ TIMEZONE = "Europe/Brussels"
 # Use explicit relative path with leading ./ so assets sit next to the script path-wise
 IMAGES_DIR = "."
 ALLOWED_EXTS = {".jpg", ".jpeg", ".png"}
+_IMAGE_SUFFIXES = tuple(ALLOWED_EXTS)  # pour str.endswith (un seul appel C par nom)
 IMAGE_RECENCY_DAYS = 14
+IMAGE_MAX_BYTES = 1_000_000  # limite Bluesky par blob image
+IMAGE_MAX_SIDE = 2000
 
 # Quiet hours: no posting at night
 NO_POST_START_HOUR = 23  # inclusive
 NO_POST_END_HOUR = 7     # exclusive
 
+
+def _hour_mask(start: int, end: int) -> int:
+    # Bit h à 1 pour chaque heure h de [start, end[ (passage de minuit géré)
+    hours = range(start, end) if start <= end else list(range(start, 24)) + list(range(0, end))
+    return sum(1 << h for h in hours)
+
+
+QUIET_MASK = _hour_mask(NO_POST_START_HOUR, NO_POST_END_HOUR)
+WINDOW_MASKS = {
+    "morning": _hour_mask(7, 11),
+    "midday": _hour_mask(11, 19),
+    "evening": _hour_mask(19, 23),
+}
+LOOP_DAY_MASK = _hour_mask(7, 23)  # cadence de jour du mode --loop
+
 # Global daily caps
 MAX_POSTS_PER_DAY = 4
 MAX_ENGAGEMENTS_PER_DAY = 10  # only opt-in mentions/replies
@@ -65,17 +114,63 @@ MAX_ENGAGEMENTS_PER_DAY = 10  # only opt-in mentions/replies
 MAX_POSTS_PER_HOUR = 2
 MAX_ENGAGEMENTS_PER_HOUR = 3
 
+# Adaptive hourly posting rate (AIMD): +0.5/h per successful post, halved on 429
+POSTING_RATE_INCREASE = 0.5
+POSTING_RATE_DECREASE = 0.5
+POSTING_RATE_MIN = 0.25
+
+# Actions enchaînées par réveil (notifications + timeline récupérées une seule fois)
+MAX_ACTIONS_PER_RUN = 2
+ENGAGE_CONCURRENCY = 4  # repli sans applyWrites: likes/réponses du lot en parallèle (= pool httpx)
+
 # Random delay windows (légèrement réduits pour CI)
 DELAY_POST_MIN_S = 6
 DELAY_POST_MAX_S = 20
 DELAY_ENGAGE_MIN_S = 8
 DELAY_ENGAGE_MAX_S = 30
 
+# Tirages de délais liés une fois (bornes fixes): nap = _post_nap()
+_post_nap = functools.partial(_rng.uniform, DELAY_POST_MIN_S, DELAY_POST_MAX_S)
+_engage_nap = functools.partial(_rng.uniform, DELAY_ENGAGE_MIN_S, DELAY_ENGAGE_MAX_S)
+_start_jitter = functools.partial(_rng.uniform, 0.5, 3.0)
+_error_cooldown = functools.partial(_rng.uniform, 60, 120)
+_loop_nap_quiet = functools.partial(_rng.uniform, 70*60, 120*60)
+_loop_nap_day = functools.partial(_rng.uniform, 25*60, 55*60)
+_loop_nap_other = functools.partial(_rng.uniform, 45*60, 80*60)
+_loop_nap_extra = functools.partial(_rng.uniform, 20*60, 40*60)
+# Sieste du --loop par heure locale, résolue une fois ici (heures calmes d'abord, puis jour)
+LOOP_NAP_BY_HOUR = tuple(
+    _loop_nap_quiet if (QUIET_MASK >> h) & 1 else _loop_nap_day if (LOOP_DAY_MASK >> h) & 1 else _loop_nap_other
+    for h in range(24)
+)
+
 # ======== CAPS PAR TYPE ========
 MAX_IMG_GMGN_PER_DAY = 2      # 1 le matin + 1 le soir (au total 2)
 MAX_SHORT_LINK_PER_DAY = 1    # runtime-gated by weekly rule (≤1 link per 7 days)
 MAX_GMGN_LONG_PER_DAY = 0     # Désactivé
 
+# Per-window priority: first (action, daily cap) still under its cap wins; None = uncapped
+ACTION_POLICIES: Dict[str, Tuple[Tuple[str, Optional[int]], ...]] = {
+    # Morning 07–11: 1 image; optionally weekly link if allowed; else repost
+    "morning": (
+        ("post_img_gmgn_short", min(1, MAX_IMG_GMGN_PER_DAY)),
+        ("post_short_link", MAX_SHORT_LINK_PER_DAY),
+        ("repost", None),
+    ),
+    # Midday 11–19: **no links**; prefer repost; if image quota left, allow one image (rare)
+    "midday": (
+        ("repost", MAX_POSTS_PER_DAY),  # soft guard
+        ("post_img_gmgn_short", MAX_IMG_GMGN_PER_DAY),
+        ("repost", None),
+    ),
+    # Evening 19–23: 2nd image; link allowed weekly (not midday); else repost
+    "evening": (
+        ("post_img_gmgn_short", MAX_IMG_GMGN_PER_DAY),
+        ("post_short_link", MAX_SHORT_LINK_PER_DAY),
+        ("repost", None),
+    ),
+}
+
 # Weekly link rule
 WEEKLY_LINK_MIN_DAYS = 7
 ALLOW_LINK_MORNING_HOURS = (7, 11)    # [7,11)
@@ -87,6 +182,9 @@ ALLOW_LINK_EVENING_HOURS = (19, 23)   # [19,23)
 MAX_ONESHOT_SECONDS = int(os.getenv("MAX_ONESHOT_SECONDS", "420"))
 DEADLINE_MONO: Optional[float] = None  # fixé dans main() si --oneshot
 
+# Identifiants lus une fois au démarrage (fixes pour toute la durée du process)
+HANDLE = os.getenv("BSKY_HANDLE", "").strip()
+
 # ========== TEXT LIBRARIES ==========
 GM_SHORT = [
     "GM ☀️",
@@ -112,20 +210,146 @@ COMMENT_SHORT = [
 ]
 COMMENT_EMOJIS = ["🔥", "👍", "👏", "😍", "✨", "🫶", "🎉", "💯", "🤝", "⚡", "🌟"]
 
+# Engagement: like OU courte réponse (75/25), la réponse étant un texte 70% du temps
+ENGAGE_WEIGHTS = {"like": 0.75, "reply_text": 0.25 * 0.7, "reply_emoji": 0.25 * 0.3}
+_ENGAGE_KINDS = tuple(ENGAGE_WEIGHTS)
+_ENGAGE_CUM_WEIGHTS = tuple(itertools.accumulate(ENGAGE_WEIGHTS.values()))
+
 # ========== STATE PERSISTENCE ==========
 STATE_FILE = "bluesky_bot_state.json"
+_LAST_SAVED_HASH: Optional[int] = None  # hash du dernier contenu écrit/lu sur disque
+_LAST_SAVED_MONO = float("-inf")  # time.monotonic() de la dernière écriture
+STATE_FLUSH_MIN_S = 10.0  # délai mini entre deux écritures non forcées
+HISTORY_MAX = 100  # posts mémorisés (anti-répétition texte / image): ~3 semaines à 4 posts/jour
+# Type d'action stocké en 1 caractère dans l'historique
+ACTION_CODES = {"post_img_gmgn_short": "i", "post_gmgn_long": "g", "post_short_link": "l", "repost": "r"}
+ACT_HIST_MAX = 8
+PROCESSED_NOTIFICATIONS_DAYS = 7  # jours de notifications traitées gardés en mémoire
+
+
+@dataclass(frozen=True)
+class Clock:
+    # Un seul "maintenant" par action, partagé par tous les helpers
+    utc: dt.datetime
+    local: dt.datetime
+    iso: str
+    epoch: float
+
+    @classmethod
+    def now(cls, tz: Optional[dt.tzinfo] = None) -> "Clock":
+        utc = dt.datetime.now(dt.timezone.utc)
+        local = utc.astimezone(tz or ZoneInfo(TIMEZONE))
+        return cls(utc=utc, local=local, iso=utc.isoformat(), epoch=utc.timestamp())
 
-@dataclass
-class DailyCounters:
-    date: str
-    posts: int
-    engagements: int
 
 @dataclass
-class HourlyCounters:
-    hour_key: str
-    posts: int
-    engagements: int
+class TokenBucket:
+    # Régulateur glissant: au plus `capacity` jetons, rechargés en continu
+    capacity: float
+    refill_per_s: float
+    tokens: float
+    ts: float
+
+    def refill(self, now: float) -> None:
+        if now > self.ts:
+            self.tokens = min(self.capacity, self.tokens + (now - self.ts) * self.refill_per_s)
+            self.ts = now
+
+    def available(self, now: float) -> int:
+        self.refill(now)
+        return int(self.tokens)
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens = max(0.0, self.tokens - 1.0)
+
+
+# name -> (capacity, period_s); la capacité vient toujours de la config courante
+BUCKET_SPECS = {
+    "posts_day": (MAX_POSTS_PER_DAY, 86400.0),
+    "posts_hour": (MAX_POSTS_PER_HOUR, 3600.0),
+    "engage_day": (MAX_ENGAGEMENTS_PER_DAY, 86400.0),
+    "engage_hour": (MAX_ENGAGEMENTS_PER_HOUR, 3600.0),
+}
+
+
+class BoundedUniq:
+    """Insertion-ordered set capped at `maxlen` (oldest evicted first).
+
+    Kept as a plain JSON list on disk; membership is O(1) in memory.
+    """
+
+    def __init__(self, items: Iterable[str] = (), maxlen: int = 500) -> None:
+        self.maxlen = maxlen
+        self._order: Deque[str] = deque()
+        self._seen: Set[str] = set()
+        for x in items:
+            self.add(x)
+
+    def add(self, x: str) -> None:
+        if x in self._seen:
+            return
+        if len(self._order) >= self.maxlen:
+            self._seen.discard(self._order.popleft())
+        self._order.append(x)
+        self._seen.add(x)
+
+    def trim(self, n: int) -> None:
+        while len(self._order) > n:
+            self._seen.discard(self._order.popleft())
+
+    def __contains__(self, x: object) -> bool:
+        return x in self._seen
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._order)
+
+
+class SeenByDay:
+    """Ids grouped by local day ({"YYYY-MM-DD": [ids]} on disk).
+
+    Membership goes through a flat set; pruning drops whole days at once.
+    """
+
+    def __init__(self, days: Optional[Dict[str, List[str]]] = None) -> None:
+        self._days: Dict[str, List[str]] = {}
+        self._seen: Set[str] = set()
+        for day, ids in sorted((days or {}).items()):
+            for x in ids:
+                self.add(x, day)
+
+    def add(self, x: str, day: str) -> None:
+        if x in self._seen:
+            return
+        self._days.setdefault(day, []).append(x)
+        self._seen.add(x)
+
+    def prune(self, oldest_day: str) -> None:
+        # Les dates ISO se comparent comme des chaînes
+        for day in [d for d in self._days if d < oldest_day]:
+            self._seen.difference_update(self._days.pop(day))
+
+    def to_json(self) -> Dict[str, List[str]]:
+        return self._days
+
+    def __contains__(self, x: object) -> bool:
+        return x in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+def _json_default(obj: Any) -> Any:
+    if isinstance(obj, (BoundedUniq, deque)):
+        return list(obj)
+    if isinstance(obj, SeenByDay):
+        return obj.to_json()
+    if isinstance(obj, TokenBucket):
+        return {"tokens": round(obj.tokens, 4), "ts": obj.ts}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
 def _pertype_zero() -> Dict[str, int]:
@@ -133,58 +357,158 @@ def _pertype_zero() -> Dict[str, int]:
 
 
 def load_state() -> Dict[str, Any]:
+    global _LAST_SAVED_HASH
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
+        with open(STATE_FILE, "rb") as f:
             try:
-                state = json.load(f)
+                state = _json_loads(f.read())
                 # Normalize shape for backward compatibility
                 state.setdefault("history", [])
-                state.setdefault("daily", {"date": "", "posts": 0, "engagements": 0})
-                state.setdefault("hourly", {"key": "", "posts": 0, "engagements": 0})
-                state.setdefault("processed_notifications", [])
+                state.setdefault("daily", {"date": ""})
+                state.setdefault("processed_notifications", {})
                 state.setdefault("recent_reposts", [])
                 state.setdefault("pertype", _pertype_zero())
                 state.setdefault("last_link_date", "")
                 state.setdefault("act_hist", [])  # list of recent action names
+                state.setdefault("blob_cache", {})
+                _hydrate_state(state)
+                _LAST_SAVED_HASH = hash(_dump_state(state))
                 return state
             except Exception:
                 pass
-    return {
+    return _hydrate_state({
         "history": [],
-        "daily": {"date": "", "posts": 0, "engagements": 0},
-        "hourly": {"key": "", "posts": 0, "engagements": 0},
-        "processed_notifications": [],
+        "daily": {"date": ""},
+        "processed_notifications": {},
         "recent_reposts": [],  # list of URIs
         "pertype": _pertype_zero(),
         "last_link_date": "",
         "act_hist": [],
-    }
+        "blob_cache": {},
+    })
 
 
-def save_state(state: Dict[str, Any]) -> None:
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def _legacy_bucket_tokens(state: Dict[str, Any], name: str, capacity: float, now_local: dt.datetime) -> float:
+    # Ancien format: compteurs fixes "daily"/"hourly"; on repart de ce qu'il restait
+    kind = "posts" if name.startswith("posts") else "engagements"
+    if name.endswith("_day"):
+        counters, key, expected = state.get("daily", {}), "date", now_local.date().isoformat()
+    else:
+        counters, key, expected = state.get("hourly", {}), "key", f"{now_local.date().isoformat()}_{now_local.hour:02d}"
+    if counters.get(key) != expected:
+        return capacity
+    return max(0.0, capacity - counters.get(kind, 0))
+
+
+def _hydrate_state(state: Dict[str, Any]) -> Dict[str, Any]:
+    # Listes JSON -> structures mémoire (reconverties en listes par _dump_state)
+    clock = Clock.now()  # une seule lecture d'horloge pour toutes les migrations
+    history = []
+    for item in state.get("history", []):
+        # Migration des anciens enregistrements: ts ISO/float -> epoch entier, "action" -> code, sans reposts
+        if not isinstance(item.get("ts"), int):
+            ts = _ts_epoch(item.get("ts"))
+            item["ts"] = int(ts) if ts is not None else 0
+        if "action" in item:
+            action = item.pop("action")
+            item["a"] = ACTION_CODES.get(action, action)
+        if item.get("a") != "r":
+            history.append(item)
+    state["history"] = deque(history, maxlen=HISTORY_MAX)
+    state["act_hist"] = deque(state.get("act_hist", []), maxlen=ACT_HIST_MAX)
+    processed = state.get("processed_notifications") or {}
+    if isinstance(processed, list):
+        # Ancien format (liste plate): tout est rangé sous aujourd'hui, purgé dans 7 jours
+        processed = {clock.local.date().isoformat(): processed}
+    state["processed_notifications"] = SeenByDay(processed)
+    state["recent_reposts"] = BoundedUniq(state.get("recent_reposts", []), maxlen=400)
+    now = clock.epoch
+    saved = state.get("buckets", {})
+    buckets = {}
+    for name, (capacity, period_s) in BUCKET_SPECS.items():
+        b = saved.get(name)
+        if b:
+            tokens, ts = min(float(b.get("tokens", capacity)), capacity), float(b.get("ts", now))
+        else:
+            tokens, ts = _legacy_bucket_tokens(state, name, capacity, clock.local), now
+        buckets[name] = TokenBucket(capacity=capacity, refill_per_s=capacity / period_s, tokens=tokens, ts=ts)
+    state["buckets"] = buckets
+    state.setdefault("posting_rate", float(MAX_POSTS_PER_HOUR))
+    _sync_posting_rate(state)
+    state.pop("hourly", None)
+    prune_blob_cache(state["blob_cache"], now)
+    # Quotas par endpoint; l'ancien format (un seul quota global) est abandonné
+    _QUOTA.update({e: q for e, q in (state.get("quota") or {}).items() if isinstance(q, dict)})
+    # Index de récence construit une fois au chargement, puis tenu à jour par remember_post
+    state["_recency"] = build_recency_index(state)
+    state["daily"].pop("engagements", None)
+    return state
+
+
+def _json_dumps(data: Any, indent: Optional[int] = None) -> bytes:
+    if orjson is not None:
+        # Dataclasses (TokenBucket) passées à `default` comme avec json, pas sérialisées d'office
+        option = orjson.OPT_PASSTHROUGH_DATACLASS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(data, default=_json_default, option=option)
+    separators = None if indent else (",", ":")
+    return json.dumps(
+        data, ensure_ascii=False, indent=indent, separators=separators, default=_json_default
+    ).encode("utf-8")
+
+
+def _json_loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _dump_state(state: Dict[str, Any], indent: Optional[int] = None) -> bytes:
+    # Les clés "_" sont des caches en mémoire (ex: index de récence), jamais persistées.
+    # Sur disque: JSON compact (pas d'indentation); --dump-state pour une version lisible
+    data = {k: v for k, v in state.items() if not k.startswith("_")}
+    # Quotas vus par le hook httpx, à chaque écriture: un 429 au login (avant toute action)
+    # doit lui aussi atteindre le disque pour le prochain run
+    data["quota"] = quota_to_json()
+    return _json_dumps(data, indent=indent)
+
+
+def save_state(state: Dict[str, Any], force: bool = False) -> None:
+    global _LAST_SAVED_HASH, _LAST_SAVED_MONO
+    # Écritures regroupées: au plus une toutes les STATE_FLUSH_MIN_S, sauf `force`
+    if not force and time.monotonic() - _LAST_SAVED_MONO < STATE_FLUSH_MIN_S:
+        return
+    payload = _dump_state(state)
+    h = hash(payload)
+    if h == _LAST_SAVED_HASH:
+        return  # rien n'a changé depuis la dernière écriture
+    # Écriture atomique: un run CI interrompu ne laisse jamais un JSON tronqué
+    tmp = STATE_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())  # données sur disque avant le rename (sinon fichier vide possible après crash)
+    os.replace(tmp, STATE_FILE)
+    _LAST_SAVED_HASH = h
+    _LAST_SAVED_MONO = time.monotonic()
+
+
+def flush_state(state: Dict[str, Any]) -> None:
+    save_state(state, force=True)
 
 
 def reset_daily_if_needed(state: Dict[str, Any], now_local: dt.datetime) -> None:
     today = now_local.date().isoformat()
     if state["daily"].get("date") != today:
-        state["daily"] = {"date": today, "posts": 0, "engagements": 0}
+        state["daily"] = {"date": today}
         # trim repost memory daily as well
-        state["recent_reposts"] = state.get("recent_reposts", [])[-200:]
+        state["recent_reposts"].trim(200)
+        oldest = (now_local.date() - dt.timedelta(days=PROCESSED_NOTIFICATIONS_DAYS)).isoformat()
+        state["processed_notifications"].prune(oldest)
+        prune_recency_index(state, now_local.timestamp())
         # reset per-type counters
         state["pertype"] = _pertype_zero()
 
 
-def reset_hourly_if_needed(state: Dict[str, Any], now_local: dt.datetime) -> None:
-    key = f"{now_local.date().isoformat()}_{now_local.hour:02d}"
-    if state["hourly"].get("key") != key:
-        state["hourly"] = {"key": key, "posts": 0, "engagements": 0}
-
-
 def _push_action_hist(state: Dict[str, Any], action: str) -> None:
-    state.setdefault("act_hist", []).append(action)
-    state["act_hist"] = state["act_hist"][-8:]
+    state["act_hist"].append(action)  # deque(maxlen=ACT_HIST_MAX): éviction automatique
 
 
 def last_action(state: Dict[str, Any]) -> Optional[str]:
@@ -192,197 +516,513 @@ def last_action(state: Dict[str, Any]) -> Optional[str]:
     return hist[-1] if hist else None
 
 
-def remember_post(state: Dict[str, Any], text: str, action: str, media: Optional[str] = None) -> None:
-    now = dt.datetime.now(tz=dt.timezone.utc).isoformat()
-    rec = {"text": text, "ts": now, "action": action}
+def remember_post(
+    state: Dict[str, Any], text: str, action: str, media: Optional[str] = None, clock: Optional[Clock] = None
+) -> None:
+    clock = clock or Clock.now()
+    _push_action_hist(state, action)
+    if action == "repost":
+        return  # l'anti-doublon des reposts passe par recent_reposts, pas par l'historique
+    ts = int(clock.epoch)
+    rec = {"text": text, "ts": ts, "a": ACTION_CODES.get(action, action)}
     if media:
         rec["media"] = media
-    state["history"].append(rec)
-    state["history"] = state["history"][-400:]
-    _push_action_hist(state, action)
-
-
-def recently_used_text(state: Dict[str, Any], text: str, days: int = 7) -> bool:
-    cutoff = dt.datetime.now(tz=dt.timezone.utc) - dt.timedelta(days=days)
-    for item in reversed(state.get("history", [])):
-        ts = item.get("ts")
-        if not ts:
-            continue
-        try:
-            when = dt.datetime.fromisoformat(ts)
-        except Exception:
-            continue
-        if when >= cutoff and item.get("text", "").strip() == text.strip():
-            return True
-    return False
+    state["history"].append(rec)  # deque(maxlen=HISTORY_MAX)
+    # Garder l'index de récence à jour plutôt que de le reconstruire
+    idx = state.get("_recency")
+    if idx is not None:
+        idx["text"][text.strip()] = ts
+        if media:
+            idx["media"][media] = ts
+
+
+def _ts_epoch(ts: Any) -> Optional[float]:
+    # "ts" d'historique: epoch entier, chaîne ISO (ou float) dans les anciens states
+    if isinstance(ts, (int, float)):
+        return float(ts)
+    try:
+        return dt.datetime.fromisoformat(ts).timestamp()
+    except (TypeError, ValueError):
+        return None
 
 
-def recently_used_media(state: Dict[str, Any], media_path: str, days: int = IMAGE_RECENCY_DAYS) -> bool:
-    cutoff = dt.datetime.now(tz=dt.timezone.utc) - dt.timedelta(days=days)
-    for item in reversed(state.get("history", [])):
-        ts = item.get("ts")
+def build_recency_index(state: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    # Un seul passage sur l'historique: dernier usage (epoch) par texte et par média
+    text_idx: Dict[str, float] = {}
+    media_idx: Dict[str, float] = {}
+    for item in state.get("history", []):
+        when = item.get("ts")
+        if not isinstance(when, (int, float)):
+            when = _ts_epoch(when)  # state non migré (hors load_state)
+            if when is None:
+                continue
+        text = item.get("text", "").strip()
+        if when > text_idx.get(text, 0.0):
+            text_idx[text] = when
         mp = item.get("media")
-        if not ts or not mp:
-            continue
-        try:
-            when = dt.datetime.fromisoformat(ts)
-        except Exception:
-            continue
-        if when >= cutoff and mp == media_path:
-            return True
-    return False
+        if mp and when > media_idx.get(mp, 0.0):
+            media_idx[mp] = when
+    return {"text": text_idx, "media": media_idx}
+
+
+def _recency_index(state: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    idx = state.get("_recency")
+    if idx is None:
+        idx = state["_recency"] = build_recency_index(state)
+    return idx
+
+
+def _recency_cutoff(days: int, now: Optional[float] = None) -> float:
+    # Epoch en deçà duquel un usage n'est plus "récent"; calculé une fois par tirage
+    return (now if now is not None else time.time()) - days * 86400
+
+
+def is_fresh(state: Dict[str, Any], kind: str, days: int, now: Optional[float] = None) -> Callable[[str], bool]:
+    # Seul prédicat de récence: index et seuil résolus une fois par tirage, puis chaque
+    # candidat ne coûte qu'un lookup + une comparaison. kind = "text" | "media"
+    cutoff = _recency_cutoff(days, now)
+    last_used = _recency_index(state)[kind]
+    if kind == "text":
+        return lambda text: last_used.get(text.strip(), 0.0) < cutoff
+    return lambda media: last_used.get(media, 0.0) < cutoff
+
+
+def prune_recency_index(state: Dict[str, Any], now: Optional[float] = None) -> None:
+    # Au-delà de la plus longue fenêtre anti-répétition, une entrée ne bloque plus rien:
+    # en --loop l'index ne grossit donc pas indéfiniment
+    cutoff = _recency_cutoff(max(IMAGE_RECENCY_DAYS, 7), now)
+    for idx in _recency_index(state).values():
+        for key in [k for k, ts in idx.items() if ts < cutoff]:
+            del idx[key]
+
+def reservoir_pick(items: Iterable[Any]) -> Optional[Any]:
+    # Échantillonnage "réservoir" (taille 1): un seul passage, aucune copie,
+    # tirage uniforme parmi les éléments produits; None si l'itérable est vide
+    chosen, n = None, 0
+    for x in items:
+        n += 1
+        if _rng.randrange(n) == 0:
+            chosen = x
+    return chosen
 
 # ========== FILES / IMAGES ==========
 
+@functools.lru_cache(maxsize=1)
+def _scan_images(folder: str, mtime_ns: int) -> Tuple[str, ...]:
+    # mtime_ns ne sert que de clé: le listing est refait quand le dossier change.
+    # Chemins formatés comme avant (pathlib) pour rester compatibles avec l'historique "media".
+    with os.scandir(folder) as it:
+        return tuple(
+            str(pathlib.PurePath(folder, e.name)) for e in it
+            if not e.name.startswith(".")  # fichiers cachés, dont les "._x.jpeg" AppleDouble de macOS
+            and e.name.lower().endswith(_IMAGE_SUFFIXES) and e.is_file()
+        )
+
+
 def list_local_images(folder: str) -> List[str]:
-    p = pathlib.Path(folder)
-    if not p.exists():
-        return []
-    return [str(f) for f in p.iterdir() if f.is_file() and f.suffix.lower() in ALLOWED_EXTS]
+    try:
+        return list(_scan_images(folder, os.stat(folder).st_mtime_ns))
+    except OSError:
+        return []  # dossier absent (ou supprimé entre le stat et le scandir)
 
 
-def pick_fresh_image(state: Dict[str, Any]) -> Optional[str]:
+def pick_fresh_image(state: Dict[str, Any], now: Optional[float] = None) -> Optional[str]:
     imgs = list_local_images(IMAGES_DIR)
     if not imgs:
         return None
-    random.shuffle(imgs)
-    for img in imgs:
-        if not recently_used_media(state, img, days=IMAGE_RECENCY_DAYS):
-            return img
-    return random.choice(imgs)
+    # Un simple filtre + tirage (pas de mélange)
+    fresh = is_fresh(state, "media", IMAGE_RECENCY_DAYS, now)
+    chosen = reservoir_pick(img for img in imgs if fresh(img))
+    return chosen if chosen is not None else _rng.choice(imgs)
 
 # ========== BSKY CLIENT & BACKOFF ==========
 
+# Modèles atproto résolus une fois (évite la chaîne d'attributs à chaque post)
+_EmbedImages = M.AppBskyEmbedImages.Main
+_EmbedImage = M.AppBskyEmbedImages.Image
+_ReplyRef = M.AppBskyFeedPost.ReplyRef
+_StrongRef = M.ComAtprotoRepoStrongRef.Main
+_Create = M.ComAtprotoRepoApplyWrites.Create
+IMAGE_ALT = "Artwork from Loufi’s Art"
+
 class RateLimitError(Exception):
     pass
 
 
+# Without Retry-After: decorrelated jitter, each wait drawn in [BASE, 3 × previous wait] and
+# capped at BACKOFF_CAP_S; the previous wait is kept per function across calls (_PREV_SLEEP)
+# and reset to BASE after a success
+BACKOFF_BASE_S = 5.0
+BACKOFF_CAP_S = 60.0
+BACKOFF_MAX_TRIES = 6  # au-delà on abandonne l'appel (pas de boucle infinie en cron)
+RETRY_AFTER_MAX_S = 45.0  # Retry-After plus long (quota journalier...): on abandonne l'appel
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    # atproto attache la réponse HTTP (status_code + headers) à ses exceptions
+    resp = getattr(exc, "response", None)
+    code = getattr(resp, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+_BACKOFF_RE = re.compile(r"429|rate ?limit", re.I)
+
+
 def _needs_backoff(exc: Exception) -> bool:
-    msg = str(exc).lower()
-    return "429" in msg or "ratelimit" in msg or "rate limit" in msg
+    code = _status_code(exc)
+    if code is not None:
+        return code == 429
+    # Pas de réponse exploitable: on retombe sur le message (un seul passage, sans copie .lower())
+    return _BACKOFF_RE.search(str(exc)) is not None
+
+
+def _is_transient(exc: Exception) -> bool:
+    # Réseau (pas de réponse) ou 5xx: ça vaut un retry; un 4xx ne changera pas en réessayant
+    if isinstance(exc, (OSError, httpx.TransportError)):
+        return True  # dont RemoteProtocolError (GOAWAY HTTP/2), que le SDK ne rebaptise pas
+    if not hasattr(exc, "response"):
+        return False  # erreur locale (validation, config...): réessayer ne sert à rien
+    code = _status_code(exc)
+    return code is None or code >= 500
 
 
 def _get_retry_after_seconds(exc: Exception) -> Optional[float]:
-    # Essaie d’extraire Retry-After si exposé par le SDK
+    # Retry-After: soit un nombre de secondes, soit une HTTP-date.
+    # À défaut, RateLimit-Reset (epoch Unix de la remise à zéro du quota, côté Bluesky)
+    resp = getattr(exc, "response", None)
+    hdrs = getattr(resp, "headers", None) or {}
     try:
-        resp = getattr(exc, "response", None)
-        if resp is not None:
-            hdrs = getattr(resp, "headers", {}) or {}
-            ra = hdrs.get("Retry-After") or hdrs.get("retry-after")
-            if ra:
-                try:
-                    return float(ra)
-                except Exception:
-                    # parfois c'est une date, on ignore
-                    return None
+        ra = hdrs.get("retry-after") or hdrs.get("Retry-After")
+        reset = hdrs.get("ratelimit-reset") or hdrs.get("RateLimit-Reset")
     except Exception:
+        return None
+    if not ra:
+        try:
+            return max(0.0, float(reset) - time.time()) if reset else None
+        except (TypeError, ValueError):
+            return None
+    try:
+        return max(0.0, float(ra))
+    except (TypeError, ValueError):
         pass
-    return None
+    try:
+        when = email.utils.parsedate_to_datetime(str(ra))
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (when - dt.datetime.now(tz=dt.timezone.utc)).total_seconds())
+
+
+def _sleep_before_retry(sleep_s: float, tag: str, reason: str) -> None:
+    if DEADLINE_MONO is not None and time.monotonic() + sleep_s >= DEADLINE_MONO:
+        print(f"[{tag}] Oneshoot deadline reached; exiting gracefully.", file=sys.stderr)
+        sys.exit(0)
+    print(f"[{tag}] {reason}; sleeping {sleep_s:.1f}s", file=sys.stderr)
+    time.sleep(sleep_s)
 
 
-def with_backoff(fn):
+_RATE_LIMIT_HITS = 0  # 429 vus depuis le dernier ajustement AIMD
+
+
+# Mémoire du rate-limit entre appels, par fonction décorée: un 429 vu sur un appel
+# retarde aussi les suivants, et l'attente reprend là où la précédente s'était arrêtée
+_NEXT_OK: Dict[str, float] = {}  # nom -> time.monotonic() avant lequel ne pas rappeler
+_PREV_SLEEP: Dict[str, float] = {}  # nom -> dernière attente (decorrelated jitter)
+
+# Quota annoncé par le serveur (en-têtes RateLimit-* de chaque réponse), par endpoint XRPC,
+# persisté dans le state: on attend la remise à zéro *avant* le 429, y compris d'un run CI
+# à l'autre. Chaque route a son propre quota: un login presque épuisé ne freine pas un like
+RATE_LIMIT_MIN_REMAINING = 3
+_QUOTA: Dict[str, Dict[str, float]] = {}  # NSID -> {"remaining", "reset_at" (epoch)}
+LOGIN_ENDPOINT = "com.atproto.server.createSession"
+WRITE_ENDPOINT = "com.atproto.repo.createRecord"
+
+
+def _track_quota(response: httpx.Response) -> None:
+    # Hook httpx, appelé pour chaque réponse (threads compris)
+    hdrs = response.headers
+    try:
+        remaining, reset_at = float(hdrs["ratelimit-remaining"]), float(hdrs["ratelimit-reset"])
+    except (KeyError, TypeError, ValueError):
+        return
+    nsid = response.request.url.path.rpartition("/")[2]  # /xrpc/<nsid>
+    _QUOTA[nsid] = {"remaining": remaining, "reset_at": reset_at}
+
+
+def quota_wait_seconds(endpoints: Iterable[str]) -> float:
+    now = time.time()
+    waits = [
+        q["reset_at"] - now for q in (_QUOTA.get(e) for e in endpoints)
+        if q and q["remaining"] < RATE_LIMIT_MIN_REMAINING
+    ]
+    return max([0.0] + waits)
+
+
+def _wait_for_quota(endpoints: Tuple[str, ...]) -> None:
+    wait = quota_wait_seconds(endpoints)
+    if wait > 0:
+        _sleep_before_retry(wait, "QUOTA", f"{', '.join(endpoints)} nearly spent until reset")
+        for e in endpoints:
+            _QUOTA.pop(e, None)
+
+
+def quota_to_json() -> Dict[str, Dict[str, float]]:
+    # Fenêtres déjà remises à zéro: rien à retenir
+    now = time.time()
+    return {e: q for e, q in _QUOTA.items() if q["reset_at"] > now}
+
+
+def with_backoff(fn=None, *, endpoints: Tuple[str, ...] = ()):
+    # `endpoints`: NSID appelés par la fonction, déclarés sur place; leur quota est vérifié
+    # avant chaque appel. @with_backoff nu = pas de pré-attente (ex: bsky_login, dont la
+    # reprise de session n'utilise pas createSession; main vérifie ce quota-là)
+    if fn is None:
+        return functools.partial(with_backoff, endpoints=endpoints)
+    name = fn.__name__
+
+    @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-        delay_base = 5.0
+        _wait_for_quota(endpoints)
+        wait = _NEXT_OK.get(name, 0.0) - time.monotonic()
+        if wait > 0:
+            _sleep_before_retry(wait, "BACKOFF", f"{name} still rate limited")
         tries = 0
+        prev_sleep = _PREV_SLEEP.get(name, BACKOFF_BASE_S)
         while True:
             try:
-                return fn(*args, **kwargs)
+                result = fn(*args, **kwargs)
+                _PREV_SLEEP.pop(name, None)  # succès: on repart de la base au prochain 429
+                return result
             except Exception as e:
                 tries += 1
 
-                if _needs_backoff(e):
+                if _needs_backoff(e) and tries < BACKOFF_MAX_TRIES:
+                    global _RATE_LIMIT_HITS
+                    _RATE_LIMIT_HITS += 1
                     retry_after = _get_retry_after_seconds(e)
+                    if retry_after is not None and retry_after > RETRY_AFTER_MAX_S:
+                        # Ni bloquer ce seul appel pendant des heures, ni reporter l'attente
+                        # sur les suivants via _NEXT_OK: l'erreur remonte
+                        raise
                     if retry_after is not None:
-                        sleep_s = max(0.0, min(retry_after, 45.0))
+                        # Le serveur sait mieux que nous: attendre ce qu'il demande (+ petit jitter)
+                        sleep_s = max(retry_after, 1.0) + _rng.uniform(0, 2)
                     else:
-                        sleep_s = min(delay_base * (2 ** (tries - 1)), 45.0)
-
-                    # lecture simple: pas besoin de 'global'
-                    if DEADLINE_MONO is not None:
-                        now = time.monotonic()
-                        if now + sleep_s >= DEADLINE_MONO:
-                            print("[BACKOFF] Oneshoot deadline reached; exiting gracefully.", file=sys.stderr)
-                            sys.exit(0)
-                    print(f"[BACKOFF] Rate limited; sleeping {sleep_s:.1f}s", file=sys.stderr)
-                    time.sleep(sleep_s)
+                        # "Decorrelated jitter": chaque attente tirée entre la base et 3x la précédente
+                        sleep_s = min(BACKOFF_CAP_S, _rng.uniform(BACKOFF_BASE_S, prev_sleep * 3))
+                        prev_sleep = _PREV_SLEEP[name] = sleep_s
+                    _NEXT_OK[name] = time.monotonic() + sleep_s
+                    _sleep_before_retry(sleep_s, "BACKOFF", "Rate limited")
                     continue
 
-                if tries <= 2:
-                    sleep_s = 2.0 * tries
-                    if DEADLINE_MONO is not None:
-                        now = time.monotonic()
-                        if now + sleep_s >= DEADLINE_MONO:
-                            print("[RETRY] Oneshoot deadline reached; exiting gracefully.", file=sys.stderr)
-                            sys.exit(0)
-                    print(f"[RETRY] {e}; sleeping {sleep_s:.1f}s", file=sys.stderr)
-                    time.sleep(sleep_s)
+                if tries <= 2 and _is_transient(e):
+                    # "Equal jitter": moitié fixe, moitié aléatoire, pour désynchroniser les runners
+                    cap = 2.0 * tries
+                    _sleep_before_retry(_rng.uniform(cap / 2, cap), "RETRY", str(e))
                     continue
 
                 raise
     return wrapper
 
 
+def _build_request() -> Request:
+    # Un seul pool httpx keep-alive pour tout le run (login, notifications, timeline,
+    # upload, posts): une poignée de main TLS au lieu d'une par appel; HTTP/2 si h2 est là
+    return Request(
+        http2=HTTP2_AVAILABLE,
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60.0),
+        event_hooks={"response": [_track_quota]},
+    )
+
+
+SESSION_FILE = ".bsky_session"  # jetons access/refresh réutilisés entre deux runs
+
+
+def _save_session(client: Client) -> None:
+    export = getattr(client, "export_session_string", None)
+    if export is None:
+        return  # SDK trop ancien: pas de session exportable
+    try:
+        fd = os.open(SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(export())
+        os.chmod(SESSION_FILE, 0o600)
+    except OSError as e:
+        print(f"[Session] could not save session: {e}", file=sys.stderr)
+
+
+def _track_session(client: Client) -> Client:
+    _save_session(client)
+    # Le SDK rafraîchit les jetons tout seul; on réécrit le fichier à chaque fois
+    on_change = getattr(client, "on_session_change", None)
+    if on_change is not None:
+        on_change(lambda *_: _save_session(client))
+    return client
+
+
 @with_backoff
 def bsky_login() -> Client:
-    handle = os.getenv("BSKY_HANDLE", "").strip()
+    handle = HANDLE
     app_pw = os.getenv("BSKY_APP_PASSWORD", "").strip()
     if not handle or not app_pw:
         raise RuntimeError("Missing BSKY_HANDLE or BSKY_APP_PASSWORD in env")
-    client = Client()
+    client = Client(request=_build_request())
+    # createSession est plafonné (30/5 min, 300/jour): réutiliser la session stockée d'abord
+    if os.path.exists(SESSION_FILE):
+        try:
+            with open(SESSION_FILE, "r", encoding="utf-8") as f:
+                client.login(session_string=f.read().strip())
+            return _track_session(client)
+        except Exception as e:
+            if _needs_backoff(e) or _is_transient(e):
+                raise  # 429 / réseau: with_backoff réessaie la reprise, sans brûler un createSession
+            print(f"[Session] stored session rejected ({e}); logging in with password", file=sys.stderr)
+    # Même client (et même pool httpx): createSession ignore la session rejetée
     client.login(handle, app_pw)
-    return client
-
-
-@with_backoff
-def post_text(client: Client, text: str, image_path: Optional[str] = None) -> Optional[str]:
-    if not image_path:
-        resp = client.send_post(text=text)
-        return getattr(resp, "uri", None)
+    return _track_session(client)
+
+
+BLOB_CACHE_TTL_S = 7 * 86400  # refs d'upload réutilisées une semaine (state["blob_cache"])
+_BlobRef = M.blob_ref.BlobRef
+
+
+@with_backoff(endpoints=("com.atproto.repo.uploadBlob",))
+def _upload_blob(client: Client, data: bytes):
+    blob = client.upload_blob(data)
+    return getattr(blob, "blob", None) or getattr(blob, "data", None)
+
+
+def _shrink_image(buf) -> bytes:
+    # Au-delà de la limite le PDS refuse le blob: on réencode en JPEG plutôt que de
+    # payer un upload voué à l'échec. Sans Pillow, on envoie tel quel.
+    if not PIL_AVAILABLE:
+        return bytes(buf)
+    with Image.open(io.BytesIO(buf)) as img:
+        img.draft("RGB", (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))  # JPEG: décodage directement réduit
+        if img.mode not in ("RGB", "L"):
+            # Palette / 1 bit: Pillow les réduirait en NEAREST quel que soit le filtre demandé
+            img = img.convert("RGB")
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)  # RGB/L: réduire avant de convertir
+        img = img.convert("RGB")
+        for quality in (85, 75, 65):
+            out = io.BytesIO()
+            img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+            if out.tell() <= IMAGE_MAX_BYTES:
+                break
+    return out.getvalue()
+
+
+@functools.lru_cache(maxsize=2)
+def _shrunk_image(path: str, sha256: str) -> bytes:
+    # sha256 ne sert que de clé (même contenu -> même JPEG): sert le ré-upload de post_text
+    # sans réencoder; pas plus de 2 images (~1 Mo chacune) gardées en --loop
+    with open(path, "rb") as f:
+        return _shrink_image(f.read())
+
+
+def _ensure_blob(client: Client, image_path: str, cache: Optional[Dict[str, Any]] = None, refresh: bool = False):
+    # Upload une seule fois par contenu: `cache` (state["blob_cache"], sha256 -> ref + ts)
+    # survit d'un run à l'autre. Le hash se fait sur un mmap (pas de copie); les octets
+    # ne sont matérialisés qu'en cas d'upload, car le SDK exige des `bytes`.
+    cache = cache if cache is not None else {}
     with open(image_path, "rb") as f:
-        blob = client.upload_blob(f.read())
-    image_ref = getattr(blob, "blob", None) or getattr(blob, "data", None)
-    embed = M.AppBskyEmbedImages.Main(
-        images=[M.AppBskyEmbedImages.Image(alt="Artwork from Loufi’s Art", image=image_ref)]
-    )
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"Empty image file: {image_path}")  # mmap refuse les fichiers vides
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            h = hashlib.sha256(mm).hexdigest()
+            hit = None if refresh else cache.get(h)
+            if hit is not None:
+                return _BlobRef.model_validate(hit["ref"]), True
+            data = _shrunk_image(image_path, h) if len(mm) > IMAGE_MAX_BYTES else bytes(mm)
+    ref = _upload_blob(client, data)
+    dump = getattr(ref, "model_dump", None)
+    if dump is not None:
+        cache[h] = {"ref": dump(mode="json", by_alias=True), "ts": time.time()}
+    return ref, False
+
+
+def prune_blob_cache(cache: Dict[str, Any], now: Optional[float] = None) -> None:
+    cutoff = (now if now is not None else time.time()) - BLOB_CACHE_TTL_S
+    for h in [h for h, e in cache.items() if e.get("ts", 0) < cutoff]:
+        del cache[h]
+
+
+@with_backoff(endpoints=(WRITE_ENDPOINT,))
+def _send(client: Client, text: str, embed=None) -> Optional[str]:
     resp = client.send_post(text=text, embed=embed)
     return getattr(resp, "uri", None)
 
 
-@with_backoff
-def list_notifications(client: Client, limit: int = 50):
+def post_text(
+    client: Client, text: str, image_path: Optional[str] = None, blob_cache: Optional[Dict[str, Any]] = None
+) -> Optional[str]:
+    if not image_path:
+        return _send(client, text)
+    image_ref, cached = _ensure_blob(client, image_path, blob_cache)
     try:
-        return client.app.bsky.notification.list_notifications(limit=limit)
-    except TypeError:
-        return client.app.bsky.notification.list_notifications()
+        return _send(client, text, _EmbedImages(images=[_EmbedImage(alt=IMAGE_ALT, image=image_ref)]))
     except Exception:
-        return client.app.bsky.notification.list_notifications()
+        if not cached:
+            raise
+        # Ref en cache refusée (blob purgé côté PDS?): un nouvel upload, un seul essai
+        image_ref, _ = _ensure_blob(client, image_path, blob_cache, refresh=True)
+        return _send(client, text, _EmbedImages(images=[_EmbedImage(alt=IMAGE_ALT, image=image_ref)]))
 
 
-@with_backoff
+@with_backoff(endpoints=("app.bsky.notification.listNotifications",))
+def list_notifications(client: Client, limit: int = 20):
+    # Les paramètres passent par `params` (des kwargs iraient à la requête HTTP).
+    # Filtre côté serveur sur les raisons utiles: likes/follows/reposts ne sont ni
+    # transférés ni parsés; SDK/serveur trop ancien pour `reasons` -> sans filtre
+    try:
+        return client.app.bsky.notification.list_notifications(
+            params={"limit": limit, "reasons": sorted(_REASON_OK)}
+        )
+    except Exception as e:
+        if _needs_backoff(e) or _is_transient(e):
+            raise  # with_backoff s'en charge; un second appel ne ferait qu'aggraver
+        return client.app.bsky.notification.list_notifications(params={"limit": limit})
+
+
+NOTIF_FETCH_MAX = 20
+NOTIF_FETCH_PER_TOKEN = 4  # notifications demandées par engagement restant (marge pour celles déjà traitées)
+
+
+def mark_notifications_seen(client: Client, seen_at: str) -> None:
+    # Un seul appel pour tout le lot; purement cosmétique, un échec n'est pas bloquant
+    try:
+        client.app.bsky.notification.update_seen({"seen_at": seen_at})
+    except Exception as e:
+        print(f"[Notif] update_seen failed: {e}", file=sys.stderr)
+
+
+@with_backoff(endpoints=(WRITE_ENDPOINT,))
 def like_post(client: Client, uri: str, cid: str) -> bool:
     client.like(uri=uri, cid=cid)
     return True
 
 
-@with_backoff
+@with_backoff(endpoints=(WRITE_ENDPOINT,))
 def repost_post(client: Client, uri: str, cid: str) -> bool:
     client.repost(uri=uri, cid=cid)
     return True
 
 
-@with_backoff
-def reply_to_post(client: Client, parent_uri: str, parent_cid: str, text: str) -> bool:
-    client.send_post(
-        text=text,
-        reply_to=M.AppBskyFeedPost.ReplyRef(
-            parent=M.AppBskyFeedPost.ReplyRefParent(uri=parent_uri, cid=parent_cid)
-        ),
-    )
+@with_backoff(endpoints=(WRITE_ENDPOINT,))
+def reply_to_post(
+    client: Client, parent_uri: str, parent_cid: str, text: str, root: Optional[Tuple[str, str]] = None
+) -> bool:
+    # `root` = (uri, cid) du début du fil; par défaut le parent lui-même
+    parent = _StrongRef(uri=parent_uri, cid=parent_cid)
+    root_ref = _StrongRef(uri=root[0], cid=root[1]) if root else parent
+    client.send_post(text=text, reply_to=_ReplyRef(parent=parent, root=root_ref))
     return True
 
 
 # Timeline fetch for safe reposts (from followed accounts only)
-@with_backoff
+@with_backoff(endpoints=("app.bsky.feed.getTimeline",))
 def get_timeline(client: Client, limit: int = 50):
     try:
         return client.get_timeline(limit=limit)
@@ -394,41 +1034,47 @@ def get_timeline(client: Client, limit: int = 50):
 # ========== CONTENT PICKERS ==========
 
 def in_time_window(now_local: dt.datetime, window: str) -> bool:
-    h = now_local.hour
-    if window == "morning":
-        return 7 <= h < 11
-    if window == "evening":
-        return 19 <= h < 23
-    if window == "midday":
-        return 11 <= h < 19
-    return False
+    return bool((WINDOW_MASKS.get(window, 0) >> now_local.hour) & 1)
 
 
 def is_quiet_hours(now_local: dt.datetime) -> bool:
-    h = now_local.hour
-    if NO_POST_START_HOUR <= NO_POST_END_HOUR:
-        return NO_POST_START_HOUR <= h < NO_POST_END_HOUR
-    # Wrap-around case
-    return h >= NO_POST_START_HOUR or h < NO_POST_END_HOUR
+    return bool((QUIET_MASK >> now_local.hour) & 1)
+
+
+def seconds_until_wake(now_local: dt.datetime) -> float:
+    # Fin des heures calmes (NO_POST_END_HOUR, minute aléatoire); 0 hors heures calmes
+    if not is_quiet_hours(now_local):
+        return 0.0
+    wake = now_local.replace(hour=NO_POST_END_HOUR, minute=_rng.randint(0, 59), second=0, microsecond=0)
+    if wake <= now_local:
+        wake += dt.timedelta(days=1)
+    return max(0.0, wake.timestamp() - now_local.timestamp())  # via epoch: juste aussi aux changements d'heure
+
 
+PICK_ATTEMPTS = 4
 
-def pick_without_recent(state: Dict[str, Any], pool: List[str]) -> str:
-    shuffled = pool[:]
-    random.shuffle(shuffled)
-    for s in shuffled:
-        if not recently_used_text(state, s):
-            return s
-    return random.choice(pool)
+
+def pick_without_recent(state: Dict[str, Any], pool: List[str], now: Optional[float] = None, days: int = 7) -> str:
+    # Quelques tirages directs d'abord (O(1) chacun; le plus souvent le premier est frais).
+    # Par rejet, le résultat reste uniforme parmi les candidats frais
+    fresh = is_fresh(state, "text", days, now)
+    for _ in range(PICK_ATTEMPTS):
+        cand = _rng.choice(pool)
+        if fresh(cand):
+            return cand
+    # Pool presque épuisé: un passage complet puis réservoir
+    chosen = reservoir_pick(s for s in pool if fresh(s))
+    return chosen if chosen is not None else _rng.choice(pool)
 
 
 def build_gm_short() -> str:
-    return random.choice(GM_SHORT)
+    return _rng.choice(GM_SHORT)
 
 
 def build_gn_short() -> str:
-    base = random.choice(GN_SHORT_BASE)
-    if random.random() < 0.85:
-        base = f"{base} {random.choice(RANDOM_GN_EMOJIS)}"
+    base = _rng.choice(GN_SHORT_BASE)
+    if _rng.random() < 0.85:
+        base = f"{base} {_rng.choice(RANDOM_GN_EMOJIS)}"
     return base
 
 
@@ -441,14 +1087,9 @@ def pick_gmgn_text(state: Dict[str, Any], now_local: dt.datetime) -> str:
     return build_gm_short()
 
 
-def pick_link_short(state: Dict[str, Any]) -> str:
+def pick_link_short(state: Dict[str, Any], now: Optional[float] = None) -> str:
     # Always return a plain URL so Bluesky renders a blue link
-    pools = LINK_POOLS[:]
-    random.shuffle(pools)
-    for url in pools:
-        if not recently_used_text(state, url):
-            return url
-    return random.choice(LINK_POOLS)
+    return pick_without_recent(state, LINK_POOLS, now=now)
 
 # ========== WEEKLY LINK LOGIC ==========
 
@@ -487,139 +1128,339 @@ def _avoid_same_action(action: str, state: Dict[str, Any]) -> str:
     return action
 
 
-def choose_action_with_caps(now_local: dt.datetime, state: Dict[str, Any]) -> str:
-    pertype = state.get("pertype", _pertype_zero())
+# Heure locale -> fenêtre nommée (ou None), calculé une fois
+_HOUR_WINDOW: Tuple[Optional[str], ...] = tuple(
+    next((w for w, m in WINDOW_MASKS.items() if (m >> h) & 1), None) for h in range(24)
+)
 
-    # Morning 07–11: prioritize 1 image; optionally weekly link if allowed; else repost
-    if 7 <= now_local.hour < 11:
-        if pertype["post_img_gmgn_short"] < MAX_IMG_GMGN_PER_DAY and pertype["post_img_gmgn_short"] == 0:
-            return "post_img_gmgn_short"
-        if can_post_weekly_link(state, now_local):
-            return "post_short_link"
-        return "repost"
 
-    # Midday 11–19: **no links**; prefer repost; if image quota left, allow one image (rare)
-    if 11 <= now_local.hour < 19:
-        if pertype["repost"] < MAX_POSTS_PER_DAY:  # soft guard
-            return "repost"
-        if pertype["post_img_gmgn_short"] < MAX_IMG_GMGN_PER_DAY:
-            return "post_img_gmgn_short"
-        return "repost"
+def _time_window(now_local: dt.datetime) -> Optional[str]:
+    return _HOUR_WINDOW[now_local.hour]
 
-    # Evening 19–23: prioritize 2nd image; else repost; link allowed weekly (not midday)
-    if 19 <= now_local.hour < 23:
-        if pertype["post_img_gmgn_short"] < MAX_IMG_GMGN_PER_DAY:
-            return "post_img_gmgn_short"
-        if can_post_weekly_link(state, now_local):
-            return "post_short_link"
-        return "repost"
 
-    # Outside windows: default to repost
+def choose_action_with_caps(now_local: dt.datetime, state: Dict[str, Any]) -> str:
+    policy = ACTION_POLICIES.get(_time_window(now_local))
+    if policy is None:
+        # Outside windows: default to repost
+        return "repost"
+    pertype = state.get("pertype", _pertype_zero())
+    for action, cap in policy:
+        if cap is not None and pertype.get(action, 0) >= cap:
+            continue
+        # Links are additionally gated by the weekly rule (never midday)
+        if action == "post_short_link" and not can_post_weekly_link(state, now_local):
+            continue
+        return action
     return "repost"
 
 # ========== OPT-IN ENGAGEMENTS (MENTIONS / REPLIES) ==========
 
-def fetch_unprocessed_mentions(client: Client, state: Dict[str, Any], handle: str, limit: int = 40):
-    res = list_notifications(client, limit=limit)
+_REASON_OK = frozenset(("mention", "reply"))
+
+
+def fetch_unprocessed_mentions(
+    client: Client, state: Dict[str, Any], handle: str, limit: int = NOTIF_FETCH_MAX, res=None
+) -> List[Tuple[str, Any]]:
+    # `res`: réponse list_notifications déjà récupérée (batch), sinon on la demande
+    if res is None:
+        res = list_notifications(client, limit=limit)
     items = getattr(res, "notifications", []) or []
-    processed = set(state.get("processed_notifications", []))
+    processed = state["processed_notifications"]
+    # Au-delà de la mémoire des traitées, une vieille mention (compte calme: elle reste dans
+    # les 20 dernières) serait likée une seconde fois; un jour de marge pour le décalage UTC
+    today = dt.date.fromisoformat(state["daily"].get("date") or dt.date.today().isoformat())
+    oldest = (today - dt.timedelta(days=PROCESSED_NOTIFICATIONS_DAYS - 1)).isoformat()
     fresh = []
+    batch: Set[str] = set()  # un même post peut remonter deux fois (mention + reply)
     for n in items:
-        reason = getattr(n, "reason", None)
-        if reason not in ("mention", "reply"):
+        if getattr(n, "reason", None) not in _REASON_OK:
+            continue
+        # uri/cid lus une fois ici: sans eux ni like ni réponse, inutile de les garder
+        uri, cid = getattr(n, "uri", None), getattr(n, "cid", None)
+        if not uri or not cid:
+            continue
+        if cid in processed or cid in batch:  # le cid sert d'identifiant de notification
             continue
-        nid = getattr(n, "cid", None) or getattr(n, "id", None) or getattr(n, "uri", None)
-        if not nid or nid in processed:
+        indexed = getattr(n, "indexed_at", None)
+        if indexed and indexed[:10] < oldest:
             continue
-        fresh.append(n)
+        batch.add(cid)
+        fresh.append((cid, n))  # id déjà calculé: l'appelant n'a pas à le refaire
     return fresh
 
 
-def engage_for_notification(client: Client, n) -> Optional[str]:
-    uri = getattr(n, "uri", None)
-    cid = getattr(n, "cid", None)
-    if not uri or not cid:
-        return None
-    # Keep engagement minimal: like OR brief thank-you reply (75/25)
-    if random.random() < 0.75:
-        like_post(client, uri, cid)
-        return "like"
+def _thread_root(n) -> Optional[Tuple[str, str]]:
+    # Si la mention est elle-même une réponse, la nôtre doit garder la même racine
+    reply = getattr(getattr(n, "record", None), "reply", None)
+    root = getattr(reply, "root", None)
+    uri, cid = getattr(root, "uri", None), getattr(root, "cid", None)
+    return (uri, cid) if uri and cid else None
+
+
+def plan_engagement(n) -> str:
+    # Tirage seul (fil principal, ordre reproductible): le texte de la réponse, ou "" pour un like.
+    # `n` vient de fetch_unprocessed_mentions: uri et cid déjà vérifiés
+    # Keep engagement minimal: like OR brief thank-you reply (one weighted draw)
+    kind = _rng.choices(_ENGAGE_KINDS, cum_weights=_ENGAGE_CUM_WEIGHTS)[0]
+    if kind == "like":
+        return ""
+    return _rng.choice(COMMENT_SHORT if kind == "reply_text" else COMMENT_EMOJIS)
+
+
+def _engage_kind(reply: str) -> str:
+    return f"reply:{reply}" if reply else "like"
+
+
+def run_engagement(client: Client, n, reply: str) -> str:
+    # Appel réseau seul: peut tourner dans un thread
+    if not reply:
+        like_post(client, n.uri, n.cid)
     else:
-        reply = random.choice(COMMENT_SHORT) if random.random() < 0.7 else random.choice(COMMENT_EMOJIS)
-        reply_to_post(client, uri, cid, reply)
-        return f"reply:{reply}"
+        reply_to_post(client, n.uri, n.cid, reply, root=_thread_root(n))
+    return _engage_kind(reply)
+
+
+def _engage_write(client: Client, n, reply: str):
+    # Même record que client.like / client.send_post, mais à passer dans un applyWrites
+    now = client.get_current_time_iso()
+    subject = _StrongRef(uri=n.uri, cid=n.cid)
+    if not reply:
+        return _Create(collection="app.bsky.feed.like", value=M.AppBskyFeedLike.Record(subject=subject, created_at=now))
+    root = _thread_root(n)
+    root_ref = _StrongRef(uri=root[0], cid=root[1]) if root else subject
+    record = M.AppBskyFeedPost.Record(
+        text=reply, reply=_ReplyRef(parent=subject, root=root_ref), langs=["en"], created_at=now
+    )
+    return _Create(collection="app.bsky.feed.post", value=record)
+
+
+@with_backoff(endpoints=("com.atproto.repo.applyWrites",))
+def apply_writes(client: Client, writes: list) -> None:
+    client.com.atproto.repo.apply_writes(M.ComAtprotoRepoApplyWrites.Data(repo=client.me.did, writes=writes))
+
+
+def engage_batch(client: Client, plans) -> Tuple[List[Tuple[str, str]], Optional[Exception]]:
+    # `plans`: [(nid, notification, reply)] -> ([(nid, kind)] réussis, première erreur)
+    # Un seul applyWrites pour tout le lot: une requête au lieu de N, atomique côté PDS
+    try:
+        apply_writes(client, [_engage_write(client, n, reply) for _, n, reply in plans])
+        return [(nid, _engage_kind(reply)) for nid, _, reply in plans], None
+    except Exception as e:
+        if _needs_backoff(e) or _is_transient(e):
+            return [], e
+        print(f"[Engage] applyWrites failed ({e}); falling back to single calls", file=sys.stderr)
+    # applyWrites refusé / SDK sans support: appels individuels, en parallèle
+    done: List[Tuple[str, str]] = []
+    error: Optional[Exception] = None
+    with ThreadPoolExecutor(max_workers=min(ENGAGE_CONCURRENCY, len(plans))) as pool:
+        futures = [(nid, pool.submit(run_engagement, client, n, reply)) for nid, n, reply in plans]
+        for nid, fut in futures:
+            try:
+                done.append((nid, fut.result()))
+            except Exception as e:
+                error = error or e
+    return done, error
 
 # ========== SAFE REPOST PICKER ==========
 
-def pick_safe_repost(client: Client, state: Dict[str, Any], handle: str):
-    tl = get_timeline(client, limit=50)
-    feed = getattr(tl, "feed", []) or []
-    recent_reposts = set(state.get("recent_reposts", []))
-    # Iterate random order to avoid always top items
-    random.shuffle(feed)
-    for item in feed:
-        post = getattr(item, "post", None)
-        if not post:
-            continue
-        author = getattr(post, "author", None)
-        if not author:
-            continue
-        handle_self = os.getenv("BSKY_HANDLE", "").strip()
-        # Skip own posts
-        if getattr(author, "handle", "") == handle_self:
-            continue
-        uri = getattr(post, "uri", None)
-        cid = getattr(post, "cid", None)
-        if not uri or not cid:
-            continue
-        if uri in recent_reposts:
-            continue
-        # Avoid posts that are themselves reposts
-        reason = getattr(item, "reason", None)
-        if reason and getattr(reason, "$type", "").endswith("#reasonRepost"):
-            continue
-        return uri, cid
-    return None
+def _reason_type(reason) -> str:
+    return getattr(reason, "py_type", None) or getattr(reason, "$type", None) or ""
 
-# ========== ACTION ENGINE ==========
 
-def can_post(state: Dict[str, Any]) -> bool:
-    return state["daily"]["posts"] < MAX_POSTS_PER_DAY and state["hourly"]["posts"] < MAX_POSTS_PER_HOUR
+def pick_safe_repost(client: Client, state: Dict[str, Any], handle: str, tl=None):
+    # `tl`: timeline déjà récupérée (batch), sinon on la demande
+    if tl is None:
+        tl = get_timeline(client, limit=50)
+    feed = getattr(tl, "feed", []) or []
+    recent_reposts = state["recent_reposts"]
+    handle_self = handle or HANDLE
+
+    def candidates():
+        # Un passage, tests les moins chers d'abord; ne produit que des tuples (uri, cid)
+        for item in feed:
+            post = getattr(item, "post", None)
+            uri, cid = getattr(post, "uri", None), getattr(post, "cid", None)
+            if not uri or not cid or uri in recent_reposts:
+                continue
+            author = getattr(post, "author", None)
+            # Skip own posts
+            if not author or getattr(author, "handle", "") == handle_self:
+                continue
+            # Avoid posts that are themselves reposts (le SDK expose "$type" sous py_type)
+            reason = getattr(item, "reason", None)
+            if reason and _reason_type(reason).endswith("#reasonRepost"):
+                continue
+            yield uri, cid
+
+    # Uniforme parmi les éligibles (pas toujours le haut du fil), sans copie du fil
+    return reservoir_pick(candidates())
 
+# ========== ACTION ENGINE ==========
 
-def can_engage(state: Dict[str, Any]) -> bool:
-    return state["daily"]["engagements"] < MAX_ENGAGEMENTS_PER_DAY and state["hourly"]["engagements"] < MAX_ENGAGEMENTS_PER_HOUR
+def _posts_today(state: Dict[str, Any], now: float) -> int:
+    # Compteur du jour calendaire local; un "daily" d'un autre jour ne compte plus
+    today = dt.datetime.fromtimestamp(now, ZoneInfo(TIMEZONE)).date().isoformat()
+    daily = state["daily"]
+    return daily.get("posts", 0) if daily.get("date") == today else 0
+
+
+def _tokens_left(state: Dict[str, Any], kind: str, now: Optional[float] = None) -> int:
+    # kind = "posts" | "engage"; le plus restrictif des deux seaux (jour / heure).
+    # Un seau plein en début de journée se remplit encore pendant celle-ci: pour les posts,
+    # MAX_POSTS_PER_DAY reste en plus un plafond dur par jour calendaire
+    now = now if now is not None else time.time()
+    b = state["buckets"]
+    left = min(b[f"{kind}_day"].available(now), b[f"{kind}_hour"].available(now))
+    if kind == "posts":
+        left = min(left, max(0, MAX_POSTS_PER_DAY - _posts_today(state, now)))
+    return left
+
+
+def _spend(state: Dict[str, Any], kind: str, now: Optional[float] = None) -> None:
+    now = now if now is not None else time.time()
+    state["buckets"][f"{kind}_day"].take(now)
+    state["buckets"][f"{kind}_hour"].take(now)
+    if kind == "posts":
+        state["daily"]["posts"] = _posts_today(state, now) + 1
+
+
+def _sync_posting_rate(state: Dict[str, Any]) -> None:
+    # Le seau horaire des posts suit le débit AIMD (posts/heure) au lieu du cap fixe
+    rate = state["posting_rate"]
+    b = state["buckets"]["posts_hour"]
+    b.capacity = float(max(1, min(MAX_POSTS_PER_HOUR, int(rate))))
+    b.refill_per_s = rate / 3600.0
+    b.tokens = min(b.tokens, b.capacity)
+
+
+def adjust_posting_rate(state: Dict[str, Any], posted: bool) -> None:
+    # AIMD: +α après un post réussi, ×β dès qu'un 429 a été vu pendant l'action
+    global _RATE_LIMIT_HITS
+    rate = state["posting_rate"]
+    hits = _RATE_LIMIT_HITS
+    if hits:
+        rate = max(POSTING_RATE_MIN, rate * POSTING_RATE_DECREASE)
+        _RATE_LIMIT_HITS = 0
+    elif posted:
+        rate = min(float(MAX_POSTS_PER_HOUR), rate + POSTING_RATE_INCREASE)
+    state["posting_rate"] = rate
+    _sync_posting_rate(state)
+    print(f"[AIMD] posting_rate={rate:.2f}/h (429s: {hits})")
+
+
+def can_post(state: Dict[str, Any], now: Optional[float] = None) -> bool:
+    return _tokens_left(state, "posts", now) >= 1
+
+
+def can_engage(state: Dict[str, Any], now: Optional[float] = None) -> bool:
+    return _tokens_left(state, "engage", now) >= 1
+
+
+def _settle(state: Dict[str, Any], nap: float) -> None:
+    # Persister tout de suite: un kill pendant la sieste ne doit pas faire oublier l'action.
+    # La sieste elle-même n'est due qu'avant l'action suivante: si rien ne suit
+    # (fin du --oneshot, retour à la grande sieste du --loop), on ne la fait pas.
+    flush_state(state)
+    state["_nap_due"] = nap
+
+
+def _pay_nap(state: Dict[str, Any]) -> None:
+    nap = state.pop("_nap_due", 0.0)
+    if nap > 0:
+        print(f"Sleeping ~{int(nap)}s…")
+        time.sleep(nap)
 
 
-def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
-    now_local = dt.datetime.now(tz)
+def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo, notifs=None, timeline=None) -> str:
+    # Une seule écriture du state par action, même si l'action lève
+    status = None
+    try:
+        status = _run_one_action(client, state, tz, notifs, timeline)
+        return status
+    finally:
+        adjust_posting_rate(state, posted=status in ("posted", "reposted"))
+        save_state(state)
+
+
+def _action_budget(state: Dict[str, Any], now: Optional[float] = None) -> int:
+    # Au moins une action (une mention peut toujours passer), au plus ce que l'heure permet encore
+    posts_left = _tokens_left(state, "posts", now)
+    return max(1, min(posts_left, MAX_ACTIONS_PER_RUN))
+
+
+def do_actions(client: Client, state: Dict[str, Any], tz: ZoneInfo, budget: Optional[int] = None) -> List[str]:
+    # Notifications + timeline récupérées une seule fois, puis jusqu'à `budget` actions
+    # enchaînées (la sieste post-action de do_one_action sert de jitter entre elles;
+    # celle qui suit la dernière action est abandonnée)
+    clock = Clock.now(tz)
+    reset_daily_if_needed(state, clock.local)
+    if budget is None:
+        budget = _action_budget(state, clock.epoch)
+
+    # Les deux GET (et le scan du dossier d'images) sont indépendants: on les lance
+    # en parallèle, le temps mur devient celui de la requête la plus lente
+    engage_left = _tokens_left(state, "engage", clock.epoch)
+    want_timeline = can_post(state, clock.epoch) and not is_quiet_hours(clock.local)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        f_notifs = None
+        if engage_left > 0:
+            f_notifs = pool.submit(list_notifications, client, min(NOTIF_FETCH_MAX, engage_left * NOTIF_FETCH_PER_TOKEN))
+        f_timeline = pool.submit(get_timeline, client, 50) if want_timeline else None
+        if want_timeline:
+            pool.submit(list_local_images, IMAGES_DIR)
+        notifs = f_notifs.result() if f_notifs else None
+        timeline = f_timeline.result() if f_timeline else None
+
+    statuses: List[str] = []
+    for _ in range(budget):
+        status = do_one_action(client, state, tz, notifs=notifs, timeline=timeline)
+        statuses.append(status)
+        if status in ("skip", "post_failed"):
+            break
+    state.pop("_nap_due", None)
+    return statuses
+
+
+def _run_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo, notifs=None, timeline=None) -> str:
+    _pay_nap(state)
+    clock = Clock.now(tz)
+    now_local, now = clock.local, clock.epoch
     reset_daily_if_needed(state, now_local)
-    reset_hourly_if_needed(state, now_local)
+    engage_ok = can_engage(state, now)
+    post_ok = can_post(state, now) and not is_quiet_hours(now_local)
+    if not (engage_ok or post_ok):
+        print("Nothing to do (caps reached / quiet hours)")
+        return "skip"
 
-    handle = os.getenv("BSKY_HANDLE", "").strip()
+    handle = HANDLE
 
     # 1) Opt-in engagements from mentions/replies (likes allowed)
-    if can_engage(state):
-        fresh_mentions = fetch_unprocessed_mentions(client, state, handle, limit=40)
-        random.shuffle(fresh_mentions)
-        if fresh_mentions:
-            n = fresh_mentions[0]
-            kind = engage_for_notification(client, n)
-            if kind:
-                nid = getattr(n, "cid", None) or getattr(n, "id", None) or getattr(n, "uri", None)
-                if nid:
-                    state.setdefault("processed_notifications", []).append(nid)
-                    state["processed_notifications"] = state["processed_notifications"][-500:]
-                state["daily"]["engagements"] += 1
-                state["hourly"]["engagements"] += 1
-                save_state(state)
-                nap = random.uniform(DELAY_ENGAGE_MIN_S, DELAY_ENGAGE_MAX_S)
-                print(f"Engaged ({kind}). Sleeping ~{int(nap)}s...")
-                time.sleep(nap)
-                return "engaged"
+    if engage_ok:
+        fresh_mentions = fetch_unprocessed_mentions(client, state, handle, res=notifs)
+        _rng.shuffle(fresh_mentions)
+        # Tout le lot d'un coup (dans la limite des jetons): un seul GET notifications.
+        # Tirages d'abord, puis tout le lot en un applyWrites: un aller-retour, pas N
+        plans = [(nid, n, plan_engagement(n)) for nid, n in fresh_mentions[:_tokens_left(state, "engage", now)]]
+        engaged: List[str] = []
+        error: Optional[Exception] = None
+        if plans:
+            done, error = engage_batch(client, plans)
+            # Chaque succès est noté, même si un autre appel du lot a échoué
+            for nid, kind in done:
+                state["processed_notifications"].add(nid, state["daily"]["date"])
+                _spend(state, "engage", now)
+                engaged.append(kind)
+                print(f"Engaged ({kind}).")
+            if engaged:
+                _settle(state, _engage_nap())
+        if error is not None:
+            raise error
+        if engaged:
+            mark_notifications_seen(client, clock.iso)
+            return "engaged"
 
     # 2) Posting (only if allowed by caps and not during quiet hours)
-    if can_post(state) and not is_quiet_hours(now_local):
+    if post_ok:
         action = choose_action_with_caps(now_local, state)
         action = _avoid_same_action(action, state)
 
@@ -628,21 +1469,17 @@ def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
 
         # Gestion spéciale des reposts (immédiat)
         if action == "repost":
-            pick = pick_safe_repost(client, state, handle)
+            pick = pick_safe_repost(client, state, handle, tl=timeline)
             if pick:
                 uri, cid = pick
                 try:
                     repost_post(client, uri, cid)
-                    state.setdefault("recent_reposts", []).append(uri)
-                    state["recent_reposts"] = state["recent_reposts"][-400:]
-                    state["daily"]["posts"] += 1
-                    state["hourly"]["posts"] += 1
+                    state["recent_reposts"].add(uri)
+                    _spend(state, "posts", now)
                     state["pertype"]["repost"] = state.get("pertype", {}).get("repost", 0) + 1
-                    remember_post(state, text=f"REPOST:{uri}", action="repost")
-                    save_state(state)
-                    nap = random.uniform(DELAY_POST_MIN_S, DELAY_POST_MAX_S)
-                    print(f"Reposted {uri}. Sleeping ~{int(nap)}s…")
-                    time.sleep(nap)
+                    remember_post(state, text=f"REPOST:{uri}", action="repost", clock=clock)
+                    print(f"Reposted {uri}.")
+                    _settle(state, _post_nap())
                     return "reposted"
                 except Exception as e:
                     print(f"[repost] error: {e}", file=sys.stderr)
@@ -655,7 +1492,7 @@ def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
                 action = "repost"
             else:
                 text = pick_gmgn_text(state, now_local)
-                image = pick_fresh_image(state)
+                image = pick_fresh_image(state, now)
                 if image is None:
                     action = "repost"
 
@@ -663,25 +1500,21 @@ def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
             if not can_post_weekly_link(state, now_local):
                 action = "repost"
             else:
-                text = pick_link_short(state)
+                text = pick_link_short(state, now)
 
         # Si après dégradations on finit encore en repost, essayer repost une dernière fois
         if action == "repost":
-            pick = pick_safe_repost(client, state, handle)
+            pick = pick_safe_repost(client, state, handle, tl=timeline)
             if pick:
                 uri, cid = pick
                 try:
                     repost_post(client, uri, cid)
-                    state.setdefault("recent_reposts", []).append(uri)
-                    state["recent_reposts"] = state["recent_reposts"][-400:]
-                    state["daily"]["posts"] += 1
-                    state["hourly"]["posts"] += 1
+                    state["recent_reposts"].add(uri)
+                    _spend(state, "posts", now)
                     state["pertype"]["repost"] = state.get("pertype", {}).get("repost", 0) + 1
-                    remember_post(state, text=f"REPOST:{uri}", action="repost")
-                    save_state(state)
-                    nap = random.uniform(DELAY_POST_MIN_S, DELAY_POST_MAX_S)
-                    print(f"Reposted {uri}. Sleeping ~{int(nap)}s…")
-                    time.sleep(nap)
+                    remember_post(state, text=f"REPOST:{uri}", action="repost", clock=clock)
+                    print(f"Reposted {uri}.")
+                    _settle(state, _post_nap())
                     return "reposted"
                 except Exception as e:
                     print(f"[repost] error: {e}", file=sys.stderr)
@@ -694,23 +1527,20 @@ def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
             return "skip"
 
         try:
-            uri = post_text(client, text, image)
+            uri = post_text(client, text, image, blob_cache=state["blob_cache"])
         except Exception as e:
             print(f"[post] error: {e}", file=sys.stderr)
             return "post_failed"
 
         if uri:
-            remember_post(state, text, action=action, media=image)
-            state["daily"]["posts"] += 1
-            state["hourly"]["posts"] += 1
+            remember_post(state, text, action=action, media=image, clock=clock)
+            _spend(state, "posts", now)
             # incrément per-type
             state["pertype"][action] = state.get("pertype", {}).get(action, 0) + 1
             if action == "post_short_link":
                 state["last_link_date"] = now_local.date().isoformat()
-            save_state(state)
-            nap = random.uniform(DELAY_POST_MIN_S, DELAY_POST_MAX_S)
-            print(f"Posted: {text[:80]}{'…' if len(text)>80 else ''} {'[+image]' if image else ''}\nSleeping ~{int(nap)}s…")
-            time.sleep(nap)
+            print(f"Posted: {text[:80]}{'…' if len(text)>80 else ''} {'[+image]' if image else ''}")
+            _settle(state, _post_nap())
             return "posted"
 
         print("Post failed")
@@ -721,51 +1551,109 @@ def do_one_action(client: Client, state: Dict[str, Any], tz: ZoneInfo) -> str:
 
 # ========== MAIN ==========
 
+def _flush_on_sigterm(state: Dict[str, Any]) -> None:
+    # CI annulé / systemd stop: écrire ce que le regroupement des écritures retenait encore
+    def handler(signum, frame):
+        flush_state(state)
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, handler)
+
+
+def _nap(seconds: float) -> None:
+    # Sieste longue découpée: on s'arrête dès que l'échéance est passée, en temps
+    # monotone (sauts d'horloge) comme en temps mural (mise en veille de la machine)
+    mono_deadline = time.monotonic() + seconds
+    wall_deadline = time.time() + seconds
+    while True:
+        left = min(mono_deadline - time.monotonic(), wall_deadline - time.time())
+        if left <= 0:
+            return
+        time.sleep(min(left, 60.0))
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--oneshot", action="store_true", help="Perform one safe action and exit (CI mode)")
+    parser.add_argument("--oneshot", action="store_true", help="Perform a short batch of safe actions and exit (CI mode)")
     parser.add_argument("--loop", action="store_true", help="Run continuous loop with sleeps (local use)")
+    parser.add_argument("--force", action="store_true", help="Log in even during quiet hours / with caps exhausted")
+    parser.add_argument("--dump-state", action="store_true", help="Print the saved state as indented JSON and exit")
     args = parser.parse_args()
+    if args.dump_state:
+        print(_dump_state(load_state(), indent=2).decode("utf-8"))
+        sys.exit(0)
+    single_run = args.oneshot or not args.loop
+    tz = ZoneInfo(TIMEZONE)
+
+    # --- Fast path: la nuit, rien à faire -> ni login ni lecture du state ---
+    if single_run and not args.force and is_quiet_hours(dt.datetime.now(tz)):
+        print("Status: skip (quiet hours)")
+        sys.exit(0)
 
     # --- DEADLINE pour --oneshot ---
     global DEADLINE_MONO
     if args.oneshot:
         DEADLINE_MONO = time.monotonic() + MAX_ONESHOT_SECONDS
         # Petit jitter pour désaligner avec d'autres crons
-        time.sleep(random.uniform(0.5, 3.0))
+        time.sleep(_start_jitter())
     else:
         DEADLINE_MONO = None
 
-    tz = ZoneInfo(TIMEZONE)
-    client = bsky_login()
     state = load_state()
+    # Filet de sécurité: toute sortie (sys.exit, exception non gérée) écrit ce qui restait en attente
+    atexit.register(flush_state, state)
+    _flush_on_sigterm(state)
+    # Caps déjà consommés d'après le state local: inutile d'ouvrir une session
+    if single_run and not args.force and not can_post(state) and not can_engage(state):
+        print("Status: skip (caps reached)")
+        sys.exit(0)
+    # Quota de login presque épuisé au run précédent et pas de session à reprendre:
+    # le createSession serait refusé (les autres quotas sont vérifiés appel par appel)
+    login_wait = quota_wait_seconds((LOGIN_ENDPOINT,))
+    if single_run and not args.force and login_wait > 0 and not os.path.exists(SESSION_FILE):
+        print(f"Status: skip (login rate limited for ~{int(login_wait // 60)} min)")
+        sys.exit(0)
+    client = bsky_login()
 
-    if args.oneshot or not args.loop:
-        status = do_one_action(client, state, tz)
-        print(f"Status: {status}")
+    if single_run:
+        try:
+            statuses = do_actions(client, state, tz)
+        finally:
+            flush_state(state)
+        print(f"Status: {', '.join(statuses)}")
         sys.exit(0)
 
     print("Loop mode (anti-spam). Ctrl+C to stop.")
     while True:
+        # La nuit: une seule sieste jusqu'à la fin des heures calmes, sans aucun appel réseau
+        clock = Clock.now(tz)
+        wake_in = 0.0 if args.force else seconds_until_wake(clock.local)
+        if wake_in > 0:
+            flush_state(state)
+            print(f"Quiet hours: sleeping ~{int(wake_in//60)} min until morning…")
+            _nap(wake_in)
+            continue
         try:
-            do_one_action(client, state, tz)
+            # Caps épuisés: même court-circuit que le mode oneshot, pas d'appel réseau
+            if not args.force and not (can_post(state, clock.epoch) or can_engage(state, clock.epoch)):
+                print("Caps reached: skipping this round")
+            else:
+                do_actions(client, state, tz)
         except KeyboardInterrupt:
+            flush_state(state)
             raise
         except Exception as e:
-            cool = random.uniform(60, 120)
+            flush_state(state)
+            cool = _error_cooldown()
             print(f"[Loop warn] {e}. Cooling down {int(cool)}s", file=sys.stderr)
             time.sleep(cool)
-        now_local = dt.datetime.now(tz)
-        if is_quiet_hours(now_local):
-            nap = random.uniform(70*60, 120*60)
-        elif 7 <= now_local.hour < 23:
-            nap = random.uniform(25*60, 55*60)
-        else:
-            nap = random.uniform(45*60, 80*60)
-        if random.random() < 0.18:
-            nap += random.uniform(20*60, 40*60)
+        nap = LOOP_NAP_BY_HOUR[dt.datetime.now(tz).hour]()
+        if _rng.random() < 0.18:
+            nap += _loop_nap_extra()
+        # Le save_state de fin d'action a pu être absorbé par le regroupement des écritures
+        # (posting_rate, quota, round sauté): rien ne doit rester en mémoire pendant la sieste
+        flush_state(state)
         print(f"Sleeping ~{int(nap//60)} min…")
-        time.sleep(nap)
+        _nap(nap)
 
 
 if __name__ == "__main__":